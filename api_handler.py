@@ -1,6 +1,10 @@
 import os
 import random
 import string
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 from supabase import create_client, Client
 import requests
 
@@ -40,6 +44,43 @@ class SupabaseHandler:
             print(f"Error updating user {phone_number}: {e}")
             return None
 
+    def load_user_and_transition(self, phone_number: str, flow_column: str = None,
+                                 expected_state: str = None, new_state: str = None, data: dict = None,
+                                 require_column: str = None):
+        """
+        Fetches a user and applies a compare-and-set flow state transition in one RPC call.
+        The transition is only written if `flow_column` still holds `expected_state`
+        (and, if given, `require_column` is not null).
+        Returns {'user': {...}, 'transitioned': bool}, or None if the user does not exist.
+        """
+        params = {
+            'p_phone': phone_number,
+            'p_flow_column': flow_column,
+            'p_expected_state': expected_state,
+            'p_new_state': new_state,
+            'p_data': data or {},
+            'p_require_column': require_column
+        }
+        try:
+            response = self.client.rpc('load_user_and_transition', params).execute()
+            return response.data
+        except Exception as e:
+            print(f"Error loading/transitioning user {phone_number}: {e}")
+            return None
+
+    def get_users_by_account_numbers(self, account_numbers: list):
+        """Fetches the SafeHaven account ids for many account numbers, 100 per request to keep URLs short."""
+        users = []
+        try:
+            for start in range(0, len(account_numbers), 100):
+                chunk = account_numbers[start:start + 100]
+                response = self.client.table('userdetails').select('client, accountNumber, _id').in_('accountNumber', chunk).execute()
+                users.extend(response.data or [])
+            return users
+        except Exception as e:
+            print(f"Error fetching users for {len(account_numbers)} account(s): {e}")
+            return None
+
     def get_token_by_value(self, token_value: str):
         """Fetches a token's details from the 'tokens' table by its value."""
         try:
@@ -60,19 +101,114 @@ class SupabaseHandler:
             print(f"Error updating token {token_value}: {e}")
             return None
             
-    def create_plaschema_record(self, record_data: dict):
-        """Creates a new record in the plaschema table."""
+    @staticmethod
+    def _is_rejection(error: Exception) -> bool:
+        """
+        True if PostgREST refused the request itself (bad data, constraint violation, unknown
+        column): SQLSTATE classes 22/23/42 and PGRST1xx/2xx request and schema errors.
+        Network failures, 5xx and auth errors are transient and worth retrying as is.
+        """
+        code = str(getattr(error, 'code', '') or '')
+        return code[:2] in ('22', '23', '42') or code.startswith(('PGRST1', 'PGRST2'))
+
+    def create_records(self, table_name: str, records: list, on_conflict: str = None):
+        """
+        Bulk-inserts a batch of records into an append-only table in one request. With
+        `on_conflict` (a unique column), records that already exist are skipped, not rejected.
+        Returns {'status': 'success', 'data': ...} or {'status': 'error', 'error_type': 'rejected' | 'transient', ...}.
+        """
+        try:
+            table = self.client.table(table_name)
+            if on_conflict:
+                response = table.upsert(records, on_conflict=on_conflict, ignore_duplicates=True).execute()
+            else:
+                response = table.insert(records).execute()
+            return {'status': 'success', 'data': response.data}
+        except Exception as e:
+            print(f"Error bulk-inserting {len(records)} {table_name} record(s): {e}")
+            error_type = 'rejected' if self._is_rejection(e) else 'transient'
+            return {'status': 'error', 'error_type': error_type, 'message': str(e)}
+
+    def create_iyafix_plan(self, plan_data: dict):
+        """Creates a new record in the iyafix_plans table."""
+        try:
+            response = self.client.table('iyafix_plans').insert(plan_data).execute()
+            return response.data
+        except Exception as e:
+            print(f"Error creating IyaFix plan: {e}")
+            return None
+
+    def claim_due_iyafix_plans(self, worker_id: str, limit: int, lease_seconds: int = 600):
+        """Atomically claims up to `limit` matured IyaFix plans for this worker."""
+        try:
+            params = {'p_worker': worker_id, 'p_limit': limit, 'p_lease_seconds': lease_seconds}
+            response = self.client.rpc('claim_due_iyafix_plans', params).execute()
+            return response.data or []
+        except Exception as e:
+            print(f"Error claiming due IyaFix plans: {e}")
+            return None
+
+    def get_iyafix_plans_pending_funding(self, limit: int, after_id: int = 0):
+        """
+        Fetches a page of IyaFix plans still waiting for payment into their virtual
+        account and due for another funding check, by id.
+        """
+        now = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        try:
+            response = (
+                self.client.table('iyafix_plans').select('*')
+                .eq('status', 'pending_funding').gt('id', after_id)
+                .or_(f'next_funding_check_at.is.null,next_funding_check_at.lte.{now}')
+                .order('id').limit(limit)
+                .execute()
+            )
+            return response.data or []
+        except Exception as e:
+            print(f"Error fetching unfunded IyaFix plans: {e}")
+            return None
+
+    def transition_iyafix_plan(self, plan_id: int, from_status: str, data: dict):
+        """Updates a plan only if it is still in `from_status`. Returns an empty list otherwise."""
+        try:
+            response = self.client.table('iyafix_plans').update(data).eq('id', plan_id).eq('status', from_status).execute()
+            return response.data
+        except Exception as e:
+            print(f"Error updating IyaFix plan {plan_id} from {from_status}: {e}")
+            return None
+
+    def set_iyafix_settlement_reference(self, plan_id: int, worker_id: str, reference: str, attempted_at: str):
+        """
+        Records the payout reference and attempt time for a claimed plan. Only succeeds
+        if this worker still holds the claim and the plan has no other reference, so
+        returns an empty list otherwise.
+        """
+        try:
+            response = (
+                self.client.table('iyafix_plans')
+                .update({'settlement_reference': reference, 'settlement_attempted_at': attempted_at})
+                .eq('id', plan_id).eq('status', 'processing').eq('claimed_by', worker_id)
+                .or_(f'settlement_reference.is.null,settlement_reference.eq.{reference}')
+                .execute()
+            )
+            return response.data
+        except Exception as e:
+            print(f"Error setting settlement reference for IyaFix plan {plan_id}: {e}")
+            return None
+
+    def update_iyafix_plan(self, plan_id: int, data: dict):
+        """Updates an IyaFix plan record."""
         try:
-            response = self.client.table('plaschema').insert(record_data).execute()
+            response = self.client.table('iyafix_plans').update(data).eq('id', plan_id).execute()
             return response.data
         except Exception as e:
-            print(f"Error creating PLASCHEMA record: {e}")
+            print(f"Error updating IyaFix plan {plan_id}: {e}")
             return None
 
 
 class SafeHavenAPI:
-    def __init__(self, db_handler: SupabaseHandler):
+    def __init__(self, db_handler: SupabaseHandler, ledger=None):
         self.db = db_handler
+        self.ledger = ledger
         self.access_token = self._get_access_token() # Fetch token on init
         self.client_id = os.environ.get("SAFEHAVEN_CLIENT_ID")
         self.base_url = "https://api.safehavenmfb.com"
@@ -80,6 +216,16 @@ class SafeHavenAPI:
         if not self.access_token:
             raise Exception("Could not retrieve SAFEHAVEN_ACCESS_TOKEN from Supabase.")
 
+    @staticmethod
+    def response_data(result: dict) -> dict:
+        """
+        Unwraps the object from a successful _make_request result. SafeHaven wraps it as
+        {statusCode, message, data: {...}}; a flat body without that envelope is returned as is.
+        """
+        body = result.get('data') or {}
+        inner = body.get('data')
+        return inner if isinstance(inner, dict) else body
+
     def _get_access_token(self) -> str | None:
         """Fetches the latest access token from the oauth_tokens table."""
         try:
@@ -124,7 +270,7 @@ class SafeHavenAPI:
                 print("\n--- RECEIVED API APPLICATION ERROR ---")
                 print(response_data)
                 print("------------------------------------")
-                return {'status': 'error', 'message': response_data.get('message', 'Unknown API error.')}
+                return {'status': 'error', 'error_type': 'api', 'message': response_data.get('message', 'Unknown API error.')}
 
             print("\n--- RECEIVED API SUCCESS RESPONSE ---")
             print(response_data)
@@ -136,7 +282,39 @@ class SafeHavenAPI:
             print("\n--- RECEIVED HTTP/NETWORK ERROR ---")
             print(f"ERROR: {error_body}")
             print("---------------------------------")
-            return {'status': 'error', 'message': 'A network error occurred.'}
+            return {'status': 'error', 'error_type': 'network', 'message': 'A network error occurred.'}
+
+    @staticmethod
+    def unique_reference(request_id: str) -> str:
+        """A reference SafeHaven can deduplicate on, derived from the call's ledger request_id."""
+        return f"IYA{request_id[:20].upper()}"
+
+    def _make_ledgered_request(self, operation, endpoint, payload, customer_phone=None, account_number=None,
+                               beneficiary_account=None, reference=None, amount=None, request_id=None):
+        """
+        POSTs a money-moving request, appending a 'pending' ledger row before it is sent
+        and a result row with the response and timing afterwards.
+        """
+        request_id = request_id or uuid.uuid4().hex
+        started_at = time.time()
+        entry = dict(
+            phone_number=customer_phone, account_number=account_number,
+            beneficiary_account=beneficiary_account, amount=amount,
+            request_id=request_id, started_at=started_at
+        )
+        if self.ledger:
+            self.ledger.record(operation, payload, None, 0, reference=reference, **entry)
+
+        started = time.perf_counter()
+        result = self._make_request('POST', endpoint, payload)
+        duration_ms = (time.perf_counter() - started) * 1000
+
+        if self.ledger:
+            upstream = (result.get('data') or {}).get('data')
+            if reference is None and isinstance(upstream, dict):
+                reference = upstream.get('reference')
+            self.ledger.record(operation, payload, result, duration_ms, reference=reference, **entry)
+        return result
 
     def initiate_id_verification(self, id_type: str, id_number: str):
         endpoint = "/identity/v2"
@@ -168,28 +346,40 @@ class SafeHavenAPI:
         payload = { "bankCode": bank_code, "accountNumber": account_number }
         return self._make_request('POST', endpoint, payload)
 
-    def initiate_transfer(self, name_enquiry_reference: str, debit_account_number: str, beneficiary_bank_code: str, beneficiary_account_number: str, amount: int):
+    def initiate_transfer(self, name_enquiry_reference: str, debit_account_number: str, beneficiary_bank_code: str, beneficiary_account_number: str, amount: int,
+                          customer_phone: str = None, operation: str = 'transfer', payment_reference: str = None):
         def generate_random_string(length):
             return ''.join(random.choices(string.ascii_uppercase, k=length))
 
+        request_id = uuid.uuid4().hex
         endpoint = "/transfers"
         payload = {
             "saveBeneficiary": False, "nameEnquiryReference": name_enquiry_reference,
             "debitAccountNumber": debit_account_number, "beneficiaryBankCode": beneficiary_bank_code,
             "beneficiaryAccountNumber": beneficiary_account_number, "amount": amount,
-            "narration": generate_random_string(4), "paymentReference": generate_random_string(4)
+            "narration": generate_random_string(4),
+            "paymentReference": payment_reference or self.unique_reference(request_id)
         }
-        return self._make_request('POST', endpoint, payload)
+        return self._make_ledgered_request(
+            operation, endpoint, payload, customer_phone=customer_phone,
+            account_number=debit_account_number, beneficiary_account=beneficiary_account_number,
+            reference=payload["paymentReference"], amount=amount, request_id=request_id
+        )
 
-    def buy_airtime(self, amount: int, debit_account_number: str, phone_number: str, service_category_id: str):
+    def buy_airtime(self, amount: int, debit_account_number: str, phone_number: str, service_category_id: str,
+                    customer_phone: str = None):
         endpoint = "/vas/pay/airtime"
         payload = {
             "amount": amount, "channel": "WEB", "debitAccountNumber": debit_account_number,
             "phoneNumber": phone_number, "serviceCategoryId": service_category_id
         }
-        return self._make_request('POST', endpoint, payload)
+        return self._make_ledgered_request(
+            'airtime', endpoint, payload, customer_phone=customer_phone,
+            account_number=debit_account_number, amount=amount
+        )
 
-    def create_virtual_account(self, user_account_number: str, amount: int):
+    def create_virtual_account(self, user_account_number: str, amount: int, customer_phone: str = None):
+        request_id = uuid.uuid4().hex
         endpoint = "/virtual-accounts"
         payload = {
             "validFor": 72000,
@@ -199,7 +389,27 @@ class SafeHavenAPI:
             },
             "amountControl": "Fixed",
             "amount": amount,
-            "externalReference": str(random.randint(1000, 9999)),
+            "externalReference": self.unique_reference(request_id),
             "callbackUrl": "https://www.iyapays.com"
         }
-        return self._make_request('POST', endpoint, payload)
+        return self._make_ledgered_request(
+            'virtual_account', endpoint, payload, customer_phone=customer_phone,
+            account_number=user_account_number, reference=payload["externalReference"], amount=amount,
+            request_id=request_id
+        )
+
+    def get_virtual_account_transaction(self, virtual_account_id: str):
+        """Fetches the payment made into a virtual account, if any."""
+        endpoint = f"/virtual-accounts/{virtual_account_id}/transaction"
+        return self._make_request('GET', endpoint)
+
+    def get_account(self, account_id: str):
+        """Fetches a (sub-)account, including its current accountBalance."""
+        endpoint = f"/accounts/{account_id}"
+        return self._make_request('GET', endpoint)
+
+    def get_account_statement(self, account_id: str, from_date: str, to_date: str, page: int = 0, limit: int = 100):
+        """Fetches one page of a (sub-)account statement. Dates are 'YYYY-MM-DD'."""
+        query = urlencode({"fromDate": from_date, "toDate": to_date, "page": page, "limit": limit})
+        endpoint = f"/accounts/{account_id}/statement?{query}"
+        return self._make_request('GET', endpoint)
@@ -1,6 +1,9 @@
 from flask import Flask, request
 from dotenv import load_dotenv
 from api_handler import SafeHavenAPI, SupabaseHandler 
+from record_spool import RecordSpool
+from transaction_ledger import TransactionLedger
+from balance_service import BalanceService
 import os
 import logging
 from datetime import datetime, timedelta
@@ -42,10 +45,30 @@ NIGERIAN_STATES = [
     "Nasarawa", "Niger", "Ogun", "Ondo", "Osun", "Oyo", "Plateau", "Rivers",
     "Sokoto", "Taraba", "Yobe", "Zamfara", "FCT"
 ]
+# Menu choice -> (flow state column, entry state, extra columns) for the first hop of each flow.
+# These are applied together with loading the user in a single load_user_and_transition call.
+FLOW_ENTRIES = {
+    "1": ('transfer_flow_state', 'AWAITING_RECIPIENT_ACCOUNT', {}),
+    "2": ('airtime_flow_state', 'AWAITING_NETWORK', {}),
+    "3": ('voucher_flow_state', 'AWAITING_VOUCHER_CODE', {}),
+    "4": ('iyafix_flow_state', 'AWAITING_PLAN_NAME', {}),
+    "5": ('health_form_state', 'AWAITING_STATE_SELECTION', {'health_form_page': 1}),
+}
 
 # Initialize the Flask app
 app = Flask(__name__)
 
+# Write-behind spool for append-only tables (e.g. plaschema). Each worker process
+# builds its own Supabase client and flusher thread on first use. A spooled IyaFix plan
+# is skipped if its virtual account already has one (the direct insert did land).
+record_spool = RecordSpool(SupabaseHandler, upsert_keys={'iyafix_plans': 'virtual_account_id'})
+
+# Append-only record of every money-moving SafeHaven call
+ledger = TransactionLedger()
+
+# Short-TTL cache of sub-account balances, refreshed in the background
+balances = BalanceService()
+
 # --- Helper Functions ---
 
 def get_paginated_list(items, page_number, items_per_page, title):
@@ -66,13 +89,28 @@ def get_paginated_list(items, page_number, items_per_page, title):
         
     return response
 
+def parse_iyafix_duration(duration: str) -> timedelta | None:
+    """
+    Converts an IyaFix duration label such as '30 Days' or '6 Months' to a timedelta
+    (1 month = 30 days). Returns None for a missing or unrecognised label.
+    """
+    parts = (duration or '').split()
+    if len(parts) != 2 or not parts[0].isdigit():
+        return None
+    count, unit = int(parts[0]), parts[1].lower()
+    if unit.startswith('month'):
+        return timedelta(days=count * 30)
+    if unit.startswith('day'):
+        return timedelta(days=count)
+    return None
+
 @app.route("/callback", methods=['POST'])
 def ussd_callback():
     logger.info(f"--- INCOMING USSD RAW DATA ---\n{request.form}")
 
     db = SupabaseHandler()
     try:
-        api = SafeHavenAPI(db)
+        api = SafeHavenAPI(db, ledger=ledger)
     except Exception as e:
         logger.critical(f"CRITICAL: Failed to initialize SafeHavenAPI. Error: {e}")
         return "END Service is temporarily unavailable. Please try again later."
@@ -85,7 +123,20 @@ def ussd_callback():
     if phone_number and not phone_number.startswith('+'):
         phone_number = f"+{phone_number}"
 
-    user = db.get_user_by_phone(phone_number)
+    # On the first hop of a flow, load the user and enter the flow in one round trip
+    flow_entered = False
+    user = None
+    if text in FLOW_ENTRIES:
+        flow_column, entry_state, entry_data = FLOW_ENTRIES[text]
+        result = db.load_user_and_transition(
+            phone_number, flow_column, expected_state=None, new_state=entry_state,
+            data=entry_data, require_column='accountNumber'
+        )
+        if result:
+            user = result.get('user')
+            flow_entered = result.get('transitioned', False)
+    if user is None:
+        user = db.get_user_by_phone(phone_number)
     text_parts = text.split('*')
     level = len(text_parts) if text else 0
 
@@ -125,7 +176,10 @@ def ussd_callback():
             if choice == "1": # Transfer Funds
                 flow_state = user.get('transfer_flow_state')
 
-                if flow_state is None:
+                if flow_entered:
+                    response = "CON Enter beneficiary account number:"
+
+                elif flow_state is None:
                     update_result = db.update_user(phone_number, {'transfer_flow_state': 'AWAITING_RECIPIENT_ACCOUNT'})
                     if update_result:
                         response = "CON Enter beneficiary account number:"
@@ -200,8 +254,10 @@ def ussd_callback():
                             debit_account_number=user.get('accountNumber'),
                             beneficiary_bank_code=user.get('transfer_recipient_bank_code'),
                             beneficiary_account_number=user.get('transfer_recipient_account'),
-                            amount=amount
+                            amount=amount,
+                            customer_phone=phone_number
                         )
+                        balances.refresh(user.get('_id'), api, phone_number, after_update=True)
                         if transfer_result and transfer_result.get('status') == 'success':
                             response = "END Transaction Successful."
                         else:
@@ -212,7 +268,10 @@ def ussd_callback():
             elif choice == "2": # Buy Airtime
                 flow_state = user.get('airtime_flow_state')
 
-                if flow_state is None:
+                if flow_entered:
+                    response = "CON Select Network:\n1. MTN\n2. GLO\n3. Airtel\n4. 9mobile"
+
+                elif flow_state is None:
                     update_result = db.update_user(phone_number, {'airtime_flow_state': 'AWAITING_NETWORK'})
                     if update_result:
                         response = "CON Select Network:\n1. MTN\n2. GLO\n3. Airtel\n4. 9mobile"
@@ -264,8 +323,10 @@ def ussd_callback():
                             amount=amount, 
                             debit_account_number=user.get('accountNumber'), 
                             phone_number=user.get('airtime_recipient_number'), 
-                            service_category_id=user.get('airtime_service_id')
+                            service_category_id=user.get('airtime_service_id'),
+                            customer_phone=phone_number
                         )
+                        balances.refresh(user.get('_id'), api, phone_number, after_update=True)
                         if airtime_result and airtime_result.get('status') == 'success':
                             response = f"END Airtime purchase of NGN {amount} for {user.get('airtime_recipient_number')} was successful."
                         else:
@@ -276,7 +337,10 @@ def ussd_callback():
             elif choice == "3": # IyaVoucher
                 flow_state = user.get('voucher_flow_state')
 
-                if flow_state is None:
+                if flow_entered:
+                    response = "CON Enter your IyaVoucher code:"
+
+                elif flow_state is None:
                     update_result = db.update_user(phone_number, {'voucher_flow_state': 'AWAITING_VOUCHER_CODE'})
                     if update_result:
                         response = "CON Enter your IyaVoucher code:"
@@ -304,8 +368,11 @@ def ussd_callback():
                                         debit_account_number="0118816902", # Master debit account
                                         beneficiary_bank_code="090286", # SafeHaven's bank code
                                         beneficiary_account_number=user_account_number,
-                                        amount=amount_to_load
+                                        amount=amount_to_load,
+                                        customer_phone=phone_number,
+                                        operation='voucher_load'
                                     )
+                                    balances.refresh(user.get('_id'), api, phone_number, after_update=True)
                                     if transfer_result and transfer_result.get('status') == 'success':
                                         db.update_token_status(voucher_code, 'inactive')
                                         response = f"END NGN {amount_to_load} Loaded successfully."
@@ -323,7 +390,10 @@ def ussd_callback():
             elif choice == "4": # IyaFix
                 flow_state = user.get('iyafix_flow_state')
 
-                if flow_state is None:
+                if flow_entered:
+                    response = "CON Enter a name for your IyaFix plan:"
+
+                elif flow_state is None:
                     update_result = db.update_user(phone_number, {'iyafix_flow_state': 'AWAITING_PLAN_NAME'})
                     if update_result:
                         response = "CON Enter a name for your IyaFix plan:"
@@ -355,13 +425,41 @@ def ussd_callback():
                     if amount_input.isdigit():
                         amount = int(amount_input)
                         user_account = user.get('accountNumber')
-                        
-                        fix_result = api.create_virtual_account(user_account, amount)
+                        plan_name = user.get('iyafix_plan_name') or 'Your'
+                        duration = user.get('iyafix_duration')
+                        term = parse_iyafix_duration(duration)
+
+                        if term is None:
+                            logger.error(f"Unrecognised IyaFix duration {duration!r} for {phone_number}.")
+                            response = "END Plan creation failed: invalid duration. Please start again."
+                            logger.info(f"--- SENDING USSD RESPONSE ---\n{response}")
+                            return response
+
+                        fix_result = api.create_virtual_account(user_account, amount, customer_phone=phone_number)
                         
                         if fix_result and fix_result.get('status') == 'success':
-                            plan_name = user.get('iyafix_plan_name', 'Your')
-                            duration = user.get('iyafix_duration', '')
-                            response = f"END Your '{plan_name}' IyaFix of NGN {amount:,.2f} for {duration} is successful."
+                            virtual_account = SafeHavenAPI.response_data(fix_result)
+                            # The plan only becomes 'active' once the scheduler confirms payment into the virtual account
+                            plan = {
+                                'client': phone_number,
+                                'account_number': user_account,
+                                'plan_name': plan_name,
+                                'duration': duration,
+                                'amount': amount,
+                                'virtual_account_id': virtual_account.get('_id'),
+                                'virtual_account_number': virtual_account.get('accountNumber'),
+                                'status': 'pending_funding',
+                                'maturity_at': (datetime.utcnow() + term).isoformat() + 'Z'
+                            }
+                            plan_saved = db.create_iyafix_plan(plan) or record_spool.enqueue('iyafix_plans', plan)
+
+                            if plan_saved:
+                                response = f"END Your '{plan_name}' IyaFix of NGN {amount:,.2f} for {duration} has been created."
+                                if plan['virtual_account_number']:
+                                    response += f"\nPay NGN {amount:,.2f} to {plan['virtual_account_number']} (SAFE HAVEN MFB) within 20 hours to activate it."
+                            else:
+                                logger.error(f"Could not save or spool IyaFix plan: {plan}")
+                                response = "END Plan creation failed. Please try again later."
                         else:
                             error_message = fix_result.get('message', 'An unknown error occurred.')
                             response = f"END Plan creation failed: {error_message}"
@@ -371,7 +469,10 @@ def ussd_callback():
             elif choice == "5": # Health Insurance
                 flow_state = user.get('health_form_state')
 
-                if flow_state is None:
+                if flow_entered:
+                    response = get_paginated_list(NIGERIAN_STATES, 1, 5, "Select State")
+
+                elif flow_state is None:
                     update_result = db.update_user(phone_number, {'health_form_state': 'AWAITING_STATE_SELECTION', 'health_form_page': 1})
                     if update_result:
                         response = get_paginated_list(NIGERIAN_STATES, 1, 5, "Select State")
@@ -449,9 +550,9 @@ def ussd_callback():
                         'phone_number': phone_number
                     }
                     
-                    create_result = db.create_plaschema_record(record)
+                    spooled = record_spool.enqueue('plaschema', record)
                     
-                    if create_result:
+                    if spooled:
                         response = "END Your health insurance registration is successful."
                     else:
                         response = "END Registration failed. Please try again later."
@@ -459,7 +560,9 @@ def ussd_callback():
             elif choice == "9": # My Account
                 acc_num = user.get('accountNumber')
                 acc_name = user.get('accountName')
-                balance = user.get('accountBalance', 0)
+                balance = balances.get(user.get('_id'), api, phone_number)
+                if balance is None:
+                    balance = user.get('accountBalance') or 0
                 
                 response = f"END Your Account Details:\n"
                 response += f"Name: {acc_name}\n"
@@ -536,7 +639,7 @@ def ussd_callback():
             account_result = api.create_sub_account(identity_id, phone_number)
             
             if account_result and account_result.get('status') == 'success':
-                account_data = account_result.get('data', {})
+                account_data = SafeHavenAPI.response_data(account_result)
                 update_data = {
                     '_id': account_data.get('_id'),
                     'accountNumber': account_data.get('accountNumber'),
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BalanceService:
+    """
+    Cache of SafeHaven sub-account balances, shared by all workers on the host.
+
+    Balances live in a small SQLite (WAL) table, so a gunicorn worker that has never
+    refreshed an account still sees what another worker fetched. Reads never wait on
+    SafeHaven: `get` returns whatever is cached (or None) and schedules a background
+    refresh when the entry is older than the TTL. A refresh claims the account's row
+    first, so concurrent refreshes from any thread or worker share one upstream call.
+    Fresh balances are also written back to userdetails as the fallback for accounts
+    that have never been cached.
+    """
+
+    def __init__(self, path: str = None, ttl: float = None, max_workers: int = 4, refresh_lease: float = 90):
+        self.path = path or os.environ.get("BALANCE_CACHE_PATH", "balances.db")
+        self.ttl = ttl or float(os.environ.get("BALANCE_TTL", 30))
+        # Must outlast SafeHaven's 60s request timeout, or a slow fetch loses its claim
+        # to a second one mid-flight
+        self.refresh_lease = refresh_lease
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="balance-refresh")
+        self._init_schema()
+
+    def _connect(self):
+        # A connection inherited across fork (gunicorn --preload) must not be reused
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        # refresh_started_at: claim held by the worker currently fetching this account
+        # refresh_requested_at: money moved; a refresh that started earlier must run again
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS balance_cache (
+                account_id TEXT PRIMARY KEY,
+                balance REAL,
+                fetched_at REAL,
+                refresh_started_at REAL,
+                refresh_requested_at REAL
+            )
+        """)
+
+    def get(self, account_id: str, api=None, phone_number: str = None):
+        """Returns the cached balance (possibly stale) or None. Schedules a refresh if it is missing or stale."""
+        if not account_id:
+            return None
+        row = self._connect().execute(
+            "SELECT balance, fetched_at FROM balance_cache WHERE account_id = ?", (account_id,)
+        ).fetchone()
+        balance, fetched_at = row if row else (None, None)
+        if api and (fetched_at is None or time.time() - fetched_at > self.ttl):
+            self.refresh(account_id, api, phone_number)
+        return balance
+
+    def refresh(self, account_id: str, api, phone_number: str = None, after_update: bool = False):
+        """
+        Fetches the balance in the background. Returns the Future, or None if another
+        thread or worker is already refreshing this account. Pass after_update=True after
+        a money-moving operation: a refresh already in flight may have read the old
+        balance, so it is run once more when it finishes.
+        """
+        if not account_id:
+            return None
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO balance_cache (account_id) VALUES (?)", (account_id,))
+        if after_update:
+            conn.execute("UPDATE balance_cache SET refresh_requested_at = ? WHERE account_id = ?", (now, account_id))
+        claimed = conn.execute("""
+            UPDATE balance_cache SET refresh_started_at = ?
+            WHERE account_id = ? AND (refresh_started_at IS NULL OR refresh_started_at < ?)
+        """, (now, account_id, now - self.refresh_lease)).rowcount
+        if not claimed:
+            return None
+        return self._executor.submit(self._fetch, account_id, api, phone_number, now)
+
+    def _fetch(self, account_id: str, api, phone_number: str, started_at: float):
+        balance = None
+        try:
+            result = api.get_account(account_id)
+            if result.get('status') == 'success':
+                balance = api.response_data(result).get('accountBalance')
+            if balance is None:
+                print(f"Could not refresh balance for account {account_id}: {result.get('message')}")
+            return balance
+        except Exception as e:
+            print(f"Error refreshing balance for account {account_id}: {e}")
+            return None
+        finally:
+            # Every write is guarded by our claim: if the lease lapsed and another fetch
+            # took over, its result is newer and this one is dropped.
+            conn = self._connect()
+            if balance is not None:
+                stored = conn.execute("""
+                    UPDATE balance_cache SET balance = ?, fetched_at = ?, refresh_started_at = NULL
+                    WHERE account_id = ? AND refresh_started_at = ?
+                """, (balance, time.time(), account_id, started_at)).rowcount
+            else:
+                stored = 0
+                conn.execute(
+                    "UPDATE balance_cache SET refresh_started_at = NULL WHERE account_id = ? AND refresh_started_at = ?",
+                    (account_id, started_at)
+                )
+            if stored:
+                if phone_number:
+                    try:
+                        api.db.update_user(phone_number, {'accountBalance': balance})
+                    except Exception as e:
+                        print(f"Error saving balance for {phone_number}: {e}")
+                requested_at = conn.execute(
+                    "SELECT refresh_requested_at FROM balance_cache WHERE account_id = ?", (account_id,)
+                ).fetchone()[0]
+                if requested_at and requested_at > started_at:
+                    self.refresh(account_id, api, phone_number)
@@ -0,0 +1,259 @@
+"""
+Activates funded IyaFix plans and settles them at maturity.
+
+Usage: python iyafix_scheduler.py [--once] [--chunk-size N] [--concurrency N] [--poll-interval S]
+
+Each pass has two steps, both run in chunks with bounded concurrency:
+
+1. Funding: plans start as 'pending_funding'. A plan becomes 'active' only once
+   SafeHaven reports a completed payment of at least the plan amount into its
+   virtual account. Maturity is counted from that moment. An unpaid plan is checked
+   again after an exponential backoff (next_funding_check_at), and marked 'expired'
+   once its virtual account lapses.
+2. Settlement: matured 'active' plans are claimed through the claim_due_iyafix_plans
+   RPC and their principal is paid from the master account.
+
+Every plan is paid under one fixed reference (IYAFIX<id>), stored before the first
+attempt and reused on every retry. Failures before any money moves (name enquiry,
+SafeHaven rejecting the transfer) put the plan back to 'active' with a backoff.
+A transfer whose outcome is unknown (network error, crash) is marked 'unknown'.
+Before such a plan is sent again, it is resolved against the local ledger and the
+master account statement (SAFEHAVEN_MASTER_ACCOUNT_ID). If either shows the
+reference, the plan is settled without resending. If the statement cannot be
+checked, the plan stays 'unknown' and is logged for an operator. Only when the
+statement shows no payout is it retried, under the same reference.
+"""
+import argparse
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from api_handler import SafeHavenAPI, SupabaseHandler
+from reconcile_ledger import fetch_statement_references
+from transaction_ledger import TransactionLedger
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+MASTER_ACCOUNT_NUMBER = "0118816902"
+SAFEHAVEN_BANK_CODE = "090286"
+# Virtual accounts are created with validFor=72000 seconds; allow an hour for late confirmations
+FUNDING_WINDOW = timedelta(seconds=72000 + 3600)
+FUNDED_STATUSES = ('completed', 'successful', 'paid')
+MAX_BACKOFF_SECONDS = 3600
+MAX_FUNDING_CHECK_INTERVAL = 1800
+
+
+def settlement_reference(plan: dict) -> str:
+    return f"IYAFIX{plan['id']}"
+
+
+def parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def check_funding(db: SupabaseHandler, api: SafeHavenAPI, plan: dict) -> str:
+    """Activates a pending_funding plan once its virtual account is paid. Returns the outcome."""
+    now = datetime.now(timezone.utc)
+    created_at = parse_timestamp(plan['created_at'])
+
+    if plan.get('virtual_account_id'):
+        result = api.get_virtual_account_transaction(plan['virtual_account_id'])
+        if result.get('status') == 'success':
+            payment = SafeHavenAPI.response_data(result)
+            paid = float(payment.get('amount') or 0)
+            if str(payment.get('status', '')).lower() in FUNDED_STATUSES and paid >= float(plan['amount']):
+                term = parse_timestamp(plan['maturity_at']) - created_at
+                activated = db.transition_iyafix_plan(plan['id'], 'pending_funding', {
+                    'status': 'active', 'funded_at': now.isoformat(), 'maturity_at': (now + term).isoformat()
+                })
+                return 'funded' if activated else 'skipped'
+
+    if now - created_at > FUNDING_WINDOW:
+        db.transition_iyafix_plan(plan['id'], 'pending_funding', {'status': 'expired'})
+        return 'expired'
+
+    checks = (plan.get('funding_checks') or 0) + 1
+    delay = min(MAX_FUNDING_CHECK_INTERVAL, 60 * 2 ** min(checks, 10))
+    db.transition_iyafix_plan(plan['id'], 'pending_funding', {
+        'funding_checks': checks, 'next_funding_check_at': (now + timedelta(seconds=delay)).isoformat()
+    })
+    return 'unfunded'
+
+
+def retry_later(db: SupabaseHandler, plan: dict, status: str, error: str):
+    """Releases the claim and schedules the plan again after an exponential backoff."""
+    attempts = (plan.get('attempts') or 0) + 1
+    delay = min(MAX_BACKOFF_SECONDS, 60 * 2 ** min(attempts, 10))
+    db.update_iyafix_plan(plan['id'], {
+        'status': status, 'attempts': attempts, 'last_error': error,
+        'next_attempt_at': (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat(),
+        'claimed_by': None, 'claimed_at': None
+    })
+
+
+def payout_already_posted(api: SafeHavenAPI, plan: dict, reference: str):
+    """
+    Resolves an earlier attempt whose outcome was not recorded. Returns True if the
+    payout is known to have posted, False if there is no sign of it, or None if the
+    master account statement could not be checked (including when
+    SAFEHAVEN_MASTER_ACCOUNT_ID is not configured).
+    """
+    entries = api.ledger.resolve(api.ledger.entries_for_reference(reference)) if api.ledger else []
+    if any(entry['status'] == 'success' for entry in entries):
+        return True
+
+    master_account_id = os.environ.get("SAFEHAVEN_MASTER_ACCOUNT_ID")
+    if not master_account_id:
+        return None
+    attempted_at = plan.get('settlement_attempted_at') or plan['claimed_at']
+    day = parse_timestamp(attempted_at).strftime('%Y-%m-%d')
+    references = fetch_statement_references(api, master_account_id, day)
+    if references is None:
+        return None
+    return reference in references
+
+
+def mark_settled(db: SupabaseHandler, plan_id: int) -> str:
+    db.update_iyafix_plan(plan_id, {
+        'status': 'settled', 'settled_at': datetime.now(timezone.utc).isoformat(), 'last_error': None
+    })
+    return 'settled'
+
+
+def settle_plan(db: SupabaseHandler, api: SafeHavenAPI, worker_id: str, plan: dict) -> str:
+    """Pays out one claimed plan. Returns the outcome."""
+    plan_id = plan['id']
+    reference = settlement_reference(plan)
+
+    if plan.get('settlement_reference'):
+        posted = payout_already_posted(api, plan, reference)
+        if posted:
+            logger.info(f"IyaFix plan {plan_id} was already paid under {reference}.")
+            return mark_settled(db, plan_id)
+        if posted is None:
+            logger.warning(f"IyaFix plan {plan_id}: earlier payout under {reference} is unresolved and the "
+                           f"master account statement could not be checked; needs an operator to confirm.")
+            retry_later(db, plan, 'unknown', "Could not check the master account statement.")
+            return 'unknown'
+
+    name_enquiry_result = api.name_enquiry(SAFEHAVEN_BANK_CODE, plan['account_number'])
+    name_enquiry_session_id = SafeHavenAPI.response_data(name_enquiry_result).get('sessionId') \
+        if name_enquiry_result.get('status') == 'success' else None
+    if not name_enquiry_session_id:
+        # Nothing has been sent for this attempt; keep the plan's current standing and retry
+        status = 'unknown' if plan.get('settlement_reference') else 'active'
+        retry_later(db, plan, status, name_enquiry_result.get('message', 'Name enquiry failed.'))
+        return 'retry'
+
+    if not db.set_iyafix_settlement_reference(plan_id, worker_id, reference, datetime.now(timezone.utc).isoformat()):
+        logger.warning(f"IyaFix plan {plan_id} is no longer claimed by this worker; skipping.")
+        return 'skipped'
+
+    transfer_result = api.initiate_transfer(
+        name_enquiry_reference=name_enquiry_session_id,
+        debit_account_number=MASTER_ACCOUNT_NUMBER,
+        beneficiary_bank_code=SAFEHAVEN_BANK_CODE,
+        beneficiary_account_number=plan['account_number'],
+        amount=int(float(plan['amount'])),
+        customer_phone=plan['client'],
+        operation='iyafix_settlement',
+        payment_reference=reference
+    )
+    if transfer_result.get('status') == 'success':
+        return mark_settled(db, plan_id)
+
+    if transfer_result.get('error_type') == 'network':
+        retry_later(db, plan, 'unknown', transfer_result.get('message'))
+        return 'unknown'
+
+    # SafeHaven answered and rejected this attempt, so it moved no money. If an earlier
+    # attempt is still unresolved (the rejection may be a duplicate-reference one), keep it 'unknown'.
+    status = 'unknown' if plan.get('settlement_reference') else 'active'
+    retry_later(db, plan, status, transfer_result.get('message'))
+    return 'retry'
+
+
+def run_safely(step, db: SupabaseHandler, plan: dict, *args) -> str:
+    """Runs one plan's step, turning an unexpected exception into an 'error' outcome."""
+    try:
+        return step(db, *args, plan)
+    except Exception as e:
+        logger.exception(f"Error processing IyaFix plan {plan.get('id')}: {e}")
+        if step is settle_plan:
+            # The transfer may or may not have been sent; resolve it before any retry
+            try:
+                retry_later(db, plan, 'unknown', str(e))
+            except Exception:
+                logger.exception(f"Could not release IyaFix plan {plan.get('id')}; its claim will lapse.")
+        return 'error'
+
+
+def process_chunk(pool, step, db, plans, *args) -> dict:
+    outcomes = {}
+    for outcome in pool.map(lambda plan: run_safely(step, db, plan, *args), plans):
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return outcomes
+
+
+def run(chunk_size: int, concurrency: int, poll_interval: float, once: bool):
+    db = SupabaseHandler()
+    api = SafeHavenAPI(db, ledger=TransactionLedger())
+    worker_id = f"iyafix-{uuid.uuid4().hex[:12]}"
+    logger.info(f"IyaFix scheduler {worker_id} started (chunk={chunk_size}, concurrency={concurrency}).")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            funding = {}
+            last_id = 0
+            while True:
+                pending = db.get_iyafix_plans_pending_funding(chunk_size, after_id=last_id)
+                if not pending:
+                    break
+                for outcome, count in process_chunk(pool, check_funding, db, pending, api).items():
+                    funding[outcome] = funding.get(outcome, 0) + count
+                last_id = pending[-1]['id']
+            if funding:
+                logger.info(f"Checked funding for {sum(funding.values())} plan(s): {funding}")
+
+            totals = {}
+            started = time.perf_counter()
+            while True:
+                plans = db.claim_due_iyafix_plans(worker_id, chunk_size)
+                if not plans:
+                    break
+                chunk_started = time.perf_counter()
+                for outcome, count in process_chunk(pool, settle_plan, db, plans, api, worker_id).items():
+                    totals[outcome] = totals.get(outcome, 0) + count
+                chunk_elapsed = time.perf_counter() - chunk_started
+                logger.info(f"Settled chunk of {len(plans)} plan(s) in {chunk_elapsed:.1f}s "
+                            f"({len(plans) / chunk_elapsed:.1f} plans/s); running totals {totals}")
+
+            processed = sum(totals.values())
+            if processed:
+                elapsed = time.perf_counter() - started
+                logger.info(f"Batch done: {processed} plan(s) in {elapsed:.1f}s "
+                            f"({processed / elapsed:.1f} plans/s) {totals}")
+            if once:
+                return totals
+            time.sleep(poll_interval)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Activate funded IyaFix plans and settle matured ones.")
+    parser.add_argument("--once", action="store_true", help="Run one funding and settlement pass and exit.")
+    parser.add_argument("--chunk-size", type=int, default=int(os.environ.get("IYAFIX_CHUNK_SIZE", 100)))
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("IYAFIX_CONCURRENCY", 8)))
+    parser.add_argument("--poll-interval", type=float, default=float(os.environ.get("IYAFIX_POLL_INTERVAL", 60)))
+    args = parser.parse_args()
+    run(args.chunk_size, args.concurrency, args.poll_interval, args.once)
+
+
+if __name__ == "__main__":
+    main()
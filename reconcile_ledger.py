@@ -0,0 +1,127 @@
+"""
+Batch reconciliation of the local transaction ledger against SafeHaven statements.
+
+Usage: python reconcile_ledger.py [YYYY-MM-DD]   (defaults to yesterday, UTC)
+
+For every account debited in the ledger on the given day, the account statement
+is fetched once (all pages) and its references are compared in bulk with the
+ledger entries. Ledger days are UTC while statements are dated in Lagos time, so
+the statement window is widened by one day on each side. Virtual account creation
+does not move money, so it is not reconciled here.
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from api_handler import SafeHavenAPI, SupabaseHandler
+from transaction_ledger import TransactionLedger
+
+RECONCILED_OPERATIONS = ('transfer', 'voucher_load', 'airtime')
+STATEMENT_REFERENCE_KEYS = ('paymentReference', 'reference', 'externalReference')
+MASTER_ACCOUNT_NUMBER = "0118816902"
+
+
+def fetch_statement_references(api: SafeHavenAPI, account_id: str, day: str, page_size: int = 100):
+    """Returns the set of references on an account's statement around one day, or None on error."""
+    date = datetime.strptime(day, '%Y-%m-%d')
+    from_date = (date - timedelta(days=1)).strftime('%Y-%m-%d')
+    to_date = (date + timedelta(days=1)).strftime('%Y-%m-%d')
+    references = set()
+    page = 0
+    while True:
+        result = api.get_account_statement(account_id, from_date, to_date, page=page, limit=page_size)
+        if result.get('status') != 'success':
+            return None
+        entries = result.get('data', {}).get('data') or []
+        for entry in entries:
+            for key in STATEMENT_REFERENCE_KEYS:
+                if entry.get(key):
+                    references.add(entry[key])
+        if len(entries) < page_size:
+            return references
+        page += 1
+
+
+def resolve_account_ids(db: SupabaseHandler, account_numbers: list):
+    """Maps account numbers to SafeHaven account ids, including the master debit account."""
+    account_ids = {}
+    users = db.get_users_by_account_numbers(account_numbers) or []
+    for user in users:
+        if user.get('_id'):
+            account_ids[user['accountNumber']] = user['_id']
+    master_account_id = os.environ.get("SAFEHAVEN_MASTER_ACCOUNT_ID")
+    if master_account_id:
+        account_ids[MASTER_ACCOUNT_NUMBER] = master_account_id
+    return account_ids
+
+
+def reconcile_day(ledger: TransactionLedger, db: SupabaseHandler, api: SafeHavenAPI, day: str, workers: int = 4):
+    """
+    Compares one day of ledger entries with the matching SafeHaven statements.
+    Returns a report dict of entry lists keyed by discrepancy type.
+    """
+    entries = [entry for entry in ledger.resolve(ledger.entries_for_day(day)) if entry['operation'] in RECONCILED_OPERATIONS]
+    by_account = {}
+    for entry in entries:
+        by_account.setdefault(entry['account_number'], []).append(entry)
+
+    account_ids = resolve_account_ids(db, list(by_account))
+    report = {
+        'matched': [],
+        'missing_upstream': [],    # ledger says success, statement has no such reference
+        'unexpected_upstream': [], # ledger says failed, but the statement shows the reference
+        'pending_posted': [],      # no response was recorded, but the statement shows the reference
+        'pending_missing': [],     # no response was recorded and the statement has no such reference
+        'unverified': [],          # no reference or no statement available
+    }
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        statements = dict(zip(
+            account_ids,
+            pool.map(lambda account_number: fetch_statement_references(api, account_ids[account_number], day), account_ids)
+        ))
+
+    for account_number, account_entries in by_account.items():
+        references = statements.get(account_number)
+        for entry in account_entries:
+            if references is None or not entry['reference']:
+                report['unverified'].append(entry)
+            elif entry['status'] == 'pending':
+                key = 'pending_posted' if entry['reference'] in references else 'pending_missing'
+                report[key].append(entry)
+            elif entry['reference'] in references:
+                key = 'matched' if entry['status'] == 'success' else 'unexpected_upstream'
+                report[key].append(entry)
+            elif entry['status'] == 'success':
+                report['missing_upstream'].append(entry)
+            else:
+                report['matched'].append(entry)
+    return report
+
+
+def main():
+    load_dotenv()
+    if len(sys.argv) > 1:
+        day = sys.argv[1]
+    else:
+        day = (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    db = SupabaseHandler()
+    api = SafeHavenAPI(db)
+    report = reconcile_day(TransactionLedger(), db, api, day)
+
+    print(f"\n--- LEDGER RECONCILIATION FOR {day} ---")
+    for key, entries in report.items():
+        print(f"{key}: {len(entries)}")
+    for key in ('missing_upstream', 'unexpected_upstream', 'pending_posted', 'pending_missing', 'unverified'):
+        for entry in report[key]:
+            print(f"[{key}] {entry['operation']} ref={entry['reference']} account={entry['account_number']} "
+                  f"phone={entry['phone_number']} amount={entry['amount']} status={entry['status']}")
+    print("---------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
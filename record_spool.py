@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class RecordSpool:
+    """
+    Write-behind spool for append-only Supabase tables.
+
+    Records are committed to a local SQLite (WAL) file first, so the USSD hop can
+    answer as soon as the write is durable. A background thread claims pending rows
+    in batches and bulk-inserts them into Supabase, retrying with backoff on failure.
+    Rows are claimed before sending so several gunicorn workers can share one spool
+    file without inserting the same record twice.
+
+    Transient failures (network, 5xx) back off the whole batch and are retried
+    indefinitely. When Supabase rejects a batch, it is bisected so one bad record
+    cannot hold back the rest. Only rejections count toward max_attempts. A record
+    rejected that many times is dead-lettered: it stays in the spool file with
+    dead_at set, is listed by dead_letters() and can be re-queued by replay_dead_letters().
+
+    Tables listed in `upsert_keys` ({table_name: unique column}) are written with
+    ON CONFLICT DO NOTHING on that column, so a record that already reached Supabase
+    counts as delivered instead of being rejected.
+
+    Nothing runs at construction: the Supabase handler is built (from a class or
+    factory) and the flusher thread started the first time this process spools or
+    flushes. This keeps it safe to create at import time under `gunicorn --preload`.
+    Pass autostart=False to flush only by calling flush() (scripts, tests).
+    """
+
+    def __init__(self, db_handler, path: str = None, batch_size: int = None,
+                 flush_interval: float = None, claim_timeout: float = 300, max_attempts: int = None,
+                 autostart: bool = True, upsert_keys: dict = None):
+        self._db_handler = db_handler
+        self._db = None
+        self.path = path or os.environ.get("SPOOL_PATH", "spool.db")
+        self.batch_size = batch_size or int(os.environ.get("SPOOL_BATCH_SIZE", 50))
+        self.flush_interval = flush_interval or float(os.environ.get("SPOOL_FLUSH_INTERVAL", 5))
+        self.max_attempts = max_attempts or int(os.environ.get("SPOOL_MAX_ATTEMPTS", 10))
+        self.claim_timeout = claim_timeout
+        self.autostart = autostart
+        self.upsert_keys = upsert_keys or {}
+        self._pid = None
+        self._schema_ready = False
+        self._outage_backoff = 0  # seconds; grows while Supabase is unreachable
+
+    def _ensure_process(self):
+        """(Re)initialises per-process state, so a forked worker never reuses its parent's."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.worker_id = uuid.uuid4().hex
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._enqueued = 0  # records spooled by this process since the last flush
+        self._enqueued_lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        self._ensure_process()
+        if self._db is None:
+            handler = self._db_handler
+            self._db = handler if hasattr(handler, 'create_records') and not isinstance(handler, type) else handler()
+        return self._db
+
+    def _connect(self):
+        self._ensure_process()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+            if not self._schema_ready:
+                self._init_schema(conn)
+                self._schema_ready = True
+        return conn
+
+    def _init_schema(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS spooled_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                claimed_at REAL,
+                last_error TEXT,
+                dead_at REAL
+            )
+        """)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(spooled_records)")]
+        if 'dead_at' not in columns:
+            conn.execute("ALTER TABLE spooled_records ADD COLUMN dead_at REAL")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_spooled_records_pending
+            ON spooled_records (table_name, next_attempt_at, id)
+        """)
+
+    def enqueue(self, table_name: str, record: dict) -> bool:
+        """Durably spools one record. Returns True once it is committed to disk."""
+        try:
+            self._connect().execute(
+                "INSERT INTO spooled_records (table_name, payload, created_at) VALUES (?, ?, ?)",
+                (table_name, json.dumps(record), time.time())
+            )
+        except sqlite3.Error as e:
+            print(f"Error spooling {table_name} record: {e}")
+            return False
+
+        if self.autostart:
+            self.start()
+        with self._enqueued_lock:
+            self._enqueued += 1
+            if self._enqueued >= self.batch_size:
+                self._wake.set()
+        return True
+
+    def pending_count(self, table_name: str = None) -> int:
+        conn = self._connect()
+        if table_name:
+            row = conn.execute("SELECT COUNT(*) FROM spooled_records WHERE table_name = ? AND dead_at IS NULL",
+                               (table_name,)).fetchone()
+        else:
+            row = conn.execute("SELECT COUNT(*) FROM spooled_records WHERE dead_at IS NULL").fetchone()
+        return row[0]
+
+    def dead_letters(self, table_name: str = None):
+        """Lists records that were given up on, with their last error, for manual replay."""
+        query = "SELECT id, table_name, payload, attempts, last_error, created_at, dead_at FROM spooled_records WHERE dead_at IS NOT NULL"
+        params = ()
+        if table_name:
+            query += " AND table_name = ?"
+            params = (table_name,)
+        rows = self._connect().execute(query + " ORDER BY id", params).fetchall()
+        return [
+            {'id': row_id, 'table_name': name, 'record': json.loads(payload), 'attempts': attempts,
+             'last_error': last_error, 'created_at': created_at, 'dead_at': dead_at}
+            for row_id, name, payload, attempts, last_error, created_at, dead_at in rows
+        ]
+
+    def _claim_batch(self):
+        """Claims up to batch_size due rows of a single table. Returns (table_name, rows)."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            head = conn.execute("""
+                SELECT table_name FROM spooled_records
+                WHERE dead_at IS NULL AND next_attempt_at <= ? AND (claimed_by IS NULL OR claimed_at < ?)
+                ORDER BY id LIMIT 1
+            """, (now, now - self.claim_timeout)).fetchone()
+            if not head:
+                conn.execute("COMMIT")
+                return None, []
+
+            table_name = head[0]
+            rows = conn.execute("""
+                SELECT id, payload FROM spooled_records
+                WHERE table_name = ? AND dead_at IS NULL AND next_attempt_at <= ?
+                  AND (claimed_by IS NULL OR claimed_at < ?)
+                ORDER BY id LIMIT ?
+            """, (table_name, now, now - self.claim_timeout, self.batch_size)).fetchall()
+            conn.executemany(
+                "UPDATE spooled_records SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(self.worker_id, now, row_id) for row_id, _ in rows]
+            )
+            conn.execute("COMMIT")
+            return table_name, rows
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _release_row(self, row_id: int, error: str):
+        """
+        Returns a rejected row to the queue with exponential backoff (capped at 5 minutes),
+        or dead-letters it once it has used up max_attempts.
+        """
+        now = time.time()
+        self._connect().execute("""
+            UPDATE spooled_records
+            SET claimed_by = NULL, claimed_at = NULL, attempts = attempts + 1, last_error = ?,
+                next_attempt_at = ? + MIN(300, 2 * (1 << MIN(attempts, 8))),
+                dead_at = CASE WHEN attempts + 1 >= ? THEN ? END
+            WHERE id = ? AND claimed_by = ?
+        """, (error, now, self.max_attempts, now, row_id, self.worker_id))
+
+    def _defer_rows(self, rows, error: str):
+        """Returns rows to the queue after a transient failure, without using up their attempts."""
+        self._outage_backoff = min(300, max(2, self._outage_backoff * 2))
+        retry_at = time.time() + self._outage_backoff
+        self._connect().executemany("""
+            UPDATE spooled_records
+            SET claimed_by = NULL, claimed_at = NULL, last_error = ?, next_attempt_at = ?
+            WHERE id = ? AND claimed_by = ?
+        """, [(error, retry_at, row_id, self.worker_id) for row_id, _ in rows])
+
+    def _deliver(self, table_name: str, rows):
+        """
+        Inserts rows in one request, bisecting on rejection.
+        Returns (records delivered, whether a transient failure stopped delivery).
+        """
+        records = [json.loads(payload) for _, payload in rows]
+        result = self.db.create_records(table_name, records, on_conflict=self.upsert_keys.get(table_name))
+        if result.get('status') == 'success':
+            self._outage_backoff = 0
+            self._connect().executemany(
+                "DELETE FROM spooled_records WHERE id = ? AND claimed_by = ?",
+                [(row_id, self.worker_id) for row_id, _ in rows]
+            )
+            return len(rows), False
+
+        if result.get('error_type') != 'rejected':
+            self._defer_rows(rows, result.get('message', 'insert failed'))
+            return 0, True
+
+        if len(rows) == 1:
+            row_id = rows[0][0]
+            self._release_row(row_id, result.get('message', 'insert rejected'))
+            if self._connect().execute("SELECT dead_at FROM spooled_records WHERE id = ?", (row_id,)).fetchone()[0]:
+                print(f"Dead-lettered spooled {table_name} record {row_id} after {self.max_attempts} attempts.")
+            return 0, False
+
+        middle = len(rows) // 2
+        delivered, outage = self._deliver(table_name, rows[:middle])
+        if outage:
+            self._defer_rows(rows[middle:], 'deferred: Supabase unavailable')
+            return delivered, True
+        more, outage = self._deliver(table_name, rows[middle:])
+        return delivered + more, outage
+
+    def flush_once(self):
+        """
+        Sends one claimed batch to Supabase.
+        Returns (records claimed, records delivered, whether Supabase looked unavailable).
+        """
+        table_name, rows = self._claim_batch()
+        if not rows:
+            return 0, 0, False
+
+        delivered, outage = self._deliver(table_name, rows)
+        if delivered:
+            print(f"Flushed {delivered}/{len(rows)} spooled {table_name} record(s).")
+        return len(rows), delivered, outage
+
+    def flush(self) -> int:
+        """
+        Drains every due record across all tables, stopping early if Supabase is
+        unavailable. Rejected rows are pushed back by their backoff, so they are not
+        reclaimed in the same pass. Returns the number delivered.
+        """
+        self._ensure_process()
+        with self._enqueued_lock:
+            self._enqueued = 0
+        total = 0
+        while True:
+            claimed, delivered, outage = self.flush_once()
+            total += delivered
+            if not claimed or outage:
+                return total
+
+    def replay_dead_letters(self, table_name: str = None, ids: list = None) -> int:
+        """Re-queues dead-lettered records (all, one table's, or specific ids) with fresh attempts."""
+        query = """
+            UPDATE spooled_records
+            SET dead_at = NULL, attempts = 0, next_attempt_at = 0, claimed_by = NULL, claimed_at = NULL
+            WHERE dead_at IS NOT NULL
+        """
+        params = []
+        if table_name:
+            query += " AND table_name = ?"
+            params.append(table_name)
+        if ids:
+            query += f" AND id IN ({', '.join('?' for _ in ids)})"
+            params.extend(ids)
+        replayed = self._connect().execute(query, params).rowcount
+        if replayed and self.autostart:
+            self.start()
+            self._wake.set()
+        return replayed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing record spool: {e}")
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+    def start(self):
+        """Starts this process's background flusher thread (idempotent)."""
+        self._ensure_process()
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="record-spool-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
@@ -0,0 +1,53 @@
+-- Loads a user by phone number and, in the same request, applies a
+-- compare-and-set transition on one of their flow state columns.
+--
+-- Called through PostgREST as POST /rest/v1/rpc/load_user_and_transition.
+-- Returns NULL when the user does not exist, otherwise
+--   {"user": <userdetails row>, "transitioned": <bool>}
+-- where "user" reflects the row after any update was applied.
+--
+-- p_flow_column NULL      -> load only, nothing is written.
+-- p_expected_state NULL   -> the transition applies only while the column is NULL.
+-- p_data                  -> extra columns written together with the new state.
+-- p_require_column        -> if set, the transition applies only while this column is not NULL.
+create or replace function public.load_user_and_transition(
+    p_phone text,
+    p_flow_column text default null,
+    p_expected_state text default null,
+    p_new_state text default null,
+    p_data jsonb default '{}'::jsonb,
+    p_require_column text default null
+) returns jsonb
+language plpgsql
+as $$
+declare
+    v_user public.userdetails%rowtype;
+    v_typed public.userdetails%rowtype;
+    v_patch jsonb;
+    v_assignments text;
+begin
+    select * into v_user from public.userdetails where client = p_phone for update;
+    if not found then
+        return null;
+    end if;
+
+    if p_flow_column is null
+       or (to_jsonb(v_user) ->> p_flow_column) is distinct from p_expected_state
+       or (p_require_column is not null and (to_jsonb(v_user) ->> p_require_column) is null) then
+        return jsonb_build_object('user', to_jsonb(v_user), 'transitioned', false);
+    end if;
+
+    v_patch := coalesce(p_data, '{}'::jsonb) || jsonb_build_object(p_flow_column, p_new_state);
+    v_typed := jsonb_populate_record(null::public.userdetails, v_patch);
+
+    select string_agg(format('%I = ($1).%I', key, key), ', ')
+      into v_assignments
+      from jsonb_object_keys(v_patch) as key;
+
+    execute format('update public.userdetails set %s where client = $2 returning *', v_assignments)
+       into v_user
+      using v_typed, p_phone;
+
+    return jsonb_build_object('user', to_jsonb(v_user), 'transitioned', true);
+end;
+$$;
@@ -0,0 +1,75 @@
+-- IyaFix plans with a parsed maturity timestamp, settled by iyafix_scheduler.py.
+--
+-- Lifecycle:
+--   pending_funding -> active        payment into the plan's virtual account was confirmed
+--   pending_funding -> expired       the virtual account lapsed unpaid
+--   active -> processing (claimed) -> settled
+--                                  -> active   retryable failure, retried after next_attempt_at
+--                                  -> unknown  transfer sent but its outcome is unknown
+--   unknown -> processing (claimed) -> ...    resolved against the ledger / statement first
+--
+-- settlement_reference (IYAFIX<id>) is written before the first payout attempt and
+-- reused on every retry, so a retried plan can never be paid under a second reference.
+create table if not exists public.iyafix_plans (
+    id bigint generated always as identity primary key,
+    client text not null,
+    account_number text not null,
+    plan_name text,
+    duration text,
+    amount numeric not null,
+    virtual_account_id text,
+    virtual_account_number text,
+    created_at timestamptz not null default now(),
+    funded_at timestamptz,
+    maturity_at timestamptz not null,
+    status text not null default 'pending_funding'
+        check (status in ('pending_funding', 'active', 'processing', 'unknown', 'settled', 'expired')),
+    attempts integer not null default 0,
+    next_attempt_at timestamptz,
+    claimed_by text,
+    claimed_at timestamptz,
+    settlement_reference text unique,
+    settlement_attempted_at timestamptz,
+    settled_at timestamptz,
+    last_error text
+);
+
+create index if not exists iyafix_plans_due_idx
+    on public.iyafix_plans (maturity_at)
+    where status in ('active', 'unknown');
+
+create index if not exists iyafix_plans_processing_idx
+    on public.iyafix_plans (claimed_at)
+    where status = 'processing';
+
+create index if not exists iyafix_plans_pending_funding_idx
+    on public.iyafix_plans (created_at)
+    where status = 'pending_funding';
+
+create index if not exists iyafix_plans_client_idx
+    on public.iyafix_plans (client);
+
+-- Claims up to p_limit due plans for one scheduler worker: funded plans that have
+-- matured and are past their retry backoff, plus plans whose claim is older than
+-- p_lease_seconds (the worker died). pending_funding plans are never selected.
+-- SKIP LOCKED lets several schedulers run side by side.
+create or replace function public.claim_due_iyafix_plans(
+    p_worker text,
+    p_limit integer default 100,
+    p_lease_seconds integer default 600
+) returns setof public.iyafix_plans
+language sql
+as $$
+    update public.iyafix_plans p
+       set status = 'processing', claimed_by = p_worker, claimed_at = now()
+     where p.id in (
+        select id from public.iyafix_plans
+         where (status in ('active', 'unknown') and maturity_at <= now()
+                and (next_attempt_at is null or next_attempt_at <= now()))
+            or (status = 'processing' and claimed_at < now() - make_interval(secs => p_lease_seconds))
+         order by maturity_at
+         limit p_limit
+         for update skip locked
+     )
+    returning p.*;
+$$;
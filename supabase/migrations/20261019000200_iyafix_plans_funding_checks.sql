@@ -0,0 +1,20 @@
+-- One plan per virtual account, and a backoff for the funding check.
+--
+-- The app may retry saving a plan through the record spool after a direct insert whose
+-- response was lost. The unique key lets the spooled copy be written with
+-- ON CONFLICT (virtual_account_id) DO NOTHING, so the retry can never create a second plan.
+--
+-- next_funding_check_at / funding_checks: iyafix_scheduler.py checks an unpaid plan's
+-- virtual account again only after an exponential backoff, instead of on every pass.
+create unique index if not exists iyafix_plans_virtual_account_id_key
+    on public.iyafix_plans (virtual_account_id);
+
+alter table public.iyafix_plans
+    add column if not exists next_funding_check_at timestamptz,
+    add column if not exists funding_checks integer not null default 0;
+
+-- The funding pass pages through pending plans by id
+drop index if exists public.iyafix_plans_pending_funding_idx;
+create index if not exists iyafix_plans_pending_funding_idx
+    on public.iyafix_plans (id)
+    where status = 'pending_funding';
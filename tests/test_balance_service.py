@@ -0,0 +1,102 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from balance_service import BalanceService
+
+
+class StubDB:
+    def __init__(self):
+        self.updates = []
+
+    def update_user(self, phone_number, data):
+        self.updates.append((phone_number, data))
+
+
+class StubAPI:
+    """get_account returns an increasing balance; it blocks while `gate` is clear."""
+
+    def __init__(self):
+        self.db = StubDB()
+        self.calls = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+
+    def get_account(self, account_id):
+        self.calls += 1
+        self.entered.set()
+        self.gate.wait(5)
+        return {'status': 'success', 'data': {'data': {'accountBalance': 100.0 * self.calls}}}
+
+    @staticmethod
+    def response_data(result):
+        return result['data']['data']
+
+
+def make_service(tmp_path):
+    return BalanceService(str(tmp_path / "balances.db"), ttl=30)
+
+
+def test_get_returns_the_cached_balance_without_calling_upstream(tmp_path):
+    service = make_service(tmp_path)
+    service._connect().execute(
+        "INSERT INTO balance_cache (account_id, balance, fetched_at) VALUES ('acc', 250.0, ?)", (time.time(),)
+    )
+    api = StubAPI()
+
+    assert service.get('acc', api, '2348000000000') == 250.0
+    service._executor.shutdown(wait=True)
+    assert api.calls == 0
+
+
+def test_concurrent_refreshes_share_one_upstream_call(tmp_path):
+    service = make_service(tmp_path)
+    api = StubAPI()
+    api.gate.clear()
+
+    first = service.refresh('acc', api, '2348000000000')
+    assert api.entered.wait(5)
+    assert service.refresh('acc', api, '2348000000000') is None
+    api.gate.set()
+
+    assert first.result(5) == 100.0
+    service._executor.shutdown(wait=True)
+    assert api.calls == 1
+    assert api.db.updates == [('2348000000000', {'accountBalance': 100.0})]
+
+
+def test_update_during_a_fetch_reruns_it_once(tmp_path):
+    service = make_service(tmp_path)
+    api = StubAPI()
+    api.gate.clear()
+
+    first = service.refresh('acc', api)
+    assert api.entered.wait(5)
+    assert service.refresh('acc', api, after_update=True) is None
+    api.gate.set()
+
+    first.result(5)
+    service._executor.shutdown(wait=True)
+    assert api.calls == 2
+    assert service.get('acc') == 200.0
+
+
+def test_fetch_that_lost_its_claim_is_dropped(tmp_path):
+    service = make_service(tmp_path)
+    api = StubAPI()
+    api.gate.clear()
+
+    first = service.refresh('acc', api, '2348000000000')
+    assert api.entered.wait(5)
+    # The lease lapsed and another worker claimed the account
+    service._connect().execute("UPDATE balance_cache SET refresh_started_at = ? WHERE account_id = 'acc'", (time.time() + 1,))
+    api.gate.set()
+
+    first.result(5)
+    service._executor.shutdown(wait=True)
+    assert service.get('acc') is None
+    assert api.db.updates == []
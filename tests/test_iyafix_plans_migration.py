@@ -0,0 +1,55 @@
+"""
+Checks the iyafix_plans migrations against a real Postgres (see
+test_load_user_and_transition.py for how to point TEST_DATABASE_URL at one).
+"""
+import os
+from pathlib import Path
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+MIGRATIONS = Path(__file__).resolve().parent.parent / "supabase" / "migrations"
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+
+@pytest.fixture
+def cursor():
+    conn = psycopg2.connect(DATABASE_URL)
+    cur = conn.cursor()
+    for name in ("20261019000100_iyafix_plans.sql", "20261019000200_iyafix_plans_funding_checks.sql"):
+        cur.execute((MIGRATIONS / name).read_text())
+    try:
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def insert_plan(cur, virtual_account_id, on_conflict=""):
+    cur.execute(f"""
+        insert into public.iyafix_plans (client, account_number, amount, maturity_at, virtual_account_id)
+        values ('+2348000000001', '0000000001', 5000, now() + interval '30 days', %s)
+        {on_conflict}
+    """, (virtual_account_id,))
+
+
+def test_virtual_account_cannot_back_two_plans(cursor):
+    insert_plan(cursor, 'va1')
+    cursor.execute("savepoint duplicate")
+    with pytest.raises(psycopg2.errors.UniqueViolation):
+        insert_plan(cursor, 'va1')
+    cursor.execute("rollback to savepoint duplicate")
+
+    # What the record spool sends for iyafix_plans: the retry is skipped, not rejected
+    insert_plan(cursor, 'va1', "on conflict (virtual_account_id) do nothing")
+    cursor.execute("select count(*) from public.iyafix_plans where virtual_account_id = 'va1'")
+    assert cursor.fetchone()[0] == 1
+
+
+def test_new_plans_are_due_for_a_funding_check(cursor):
+    insert_plan(cursor, 'va2')
+    cursor.execute("select status, funding_checks, next_funding_check_at from public.iyafix_plans")
+    assert cursor.fetchone() == ('pending_funding', 0, None)
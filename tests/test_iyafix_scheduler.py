@@ -0,0 +1,165 @@
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("supabase")
+pytest.importorskip("requests")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import iyafix_scheduler
+
+
+class StubDB:
+    def __init__(self):
+        self.updates = []
+        self.references = []
+
+    def update_iyafix_plan(self, plan_id, data):
+        self.updates.append((plan_id, data))
+        return [data]
+
+    def set_iyafix_settlement_reference(self, plan_id, worker_id, reference, attempted_at):
+        self.references.append(reference)
+        return [{'id': plan_id}]
+
+
+class StubAPI:
+    ledger = None
+
+    def __init__(self, name_enquiry=None, transfer=None):
+        self.name_enquiry_result = name_enquiry or {'status': 'success', 'data': {'data': {'sessionId': 'S1'}}}
+        self.transfer_result = transfer or {'status': 'success', 'data': {}}
+        self.transfers = []
+
+    def name_enquiry(self, bank_code, account_number):
+        return self.name_enquiry_result
+
+    def initiate_transfer(self, **kwargs):
+        self.transfers.append(kwargs)
+        return self.transfer_result
+
+
+PLAN = {'id': 7, 'account_number': '0000000001', 'amount': '5000', 'client': '+2348000000001', 'attempts': 0}
+
+
+def last_status(db):
+    return db.updates[-1][1]['status']
+
+
+def test_settles_with_fixed_reference():
+    db, api = StubDB(), StubAPI()
+
+    assert iyafix_scheduler.settle_plan(db, api, 'w', dict(PLAN)) == 'settled'
+    assert api.transfers[0]['payment_reference'] == 'IYAFIX7'
+    assert last_status(db) == 'settled'
+
+
+def test_name_enquiry_failure_is_retried_later():
+    db, api = StubDB(), StubAPI(name_enquiry={'status': 'error', 'message': 'timeout'})
+
+    assert iyafix_scheduler.settle_plan(db, api, 'w', dict(PLAN)) == 'retry'
+    assert api.transfers == []
+    assert last_status(db) == 'active'
+    assert db.updates[-1][1]['next_attempt_at']
+
+
+def test_network_error_marks_outcome_unknown():
+    db, api = StubDB(), StubAPI(transfer={'status': 'error', 'error_type': 'network', 'message': 'A network error occurred.'})
+
+    assert iyafix_scheduler.settle_plan(db, api, 'w', dict(PLAN)) == 'unknown'
+    assert last_status(db) == 'unknown'
+
+
+def test_unresolved_payout_is_not_resent_without_the_statement(monkeypatch):
+    monkeypatch.delenv("SAFEHAVEN_MASTER_ACCOUNT_ID", raising=False)
+    db, api = StubDB(), StubAPI()
+    plan = dict(PLAN, settlement_reference='IYAFIX7', settlement_attempted_at='2026-10-19T10:00:00+00:00')
+
+    assert iyafix_scheduler.settle_plan(db, api, 'w', plan) == 'unknown'
+    assert api.transfers == []
+    assert last_status(db) == 'unknown'
+
+
+def test_retry_reuses_reference_when_statement_shows_no_payout(monkeypatch):
+    monkeypatch.setenv("SAFEHAVEN_MASTER_ACCOUNT_ID", "master")
+    monkeypatch.setattr(iyafix_scheduler, 'fetch_statement_references', lambda api, account_id, day: set())
+    db, api = StubDB(), StubAPI()
+    plan = dict(PLAN, settlement_reference='IYAFIX7', settlement_attempted_at='2026-10-19T10:00:00+00:00')
+
+    assert iyafix_scheduler.settle_plan(db, api, 'w', plan) == 'settled'
+    assert db.references == ['IYAFIX7']
+    assert api.transfers[0]['payment_reference'] == 'IYAFIX7'
+
+
+def test_exception_is_counted_and_plan_released():
+    db, api = StubDB(), StubAPI()
+    plan = dict(PLAN, amount=None)
+
+    assert iyafix_scheduler.run_safely(iyafix_scheduler.settle_plan, db, plan, api, 'w') == 'error'
+    assert last_status(db) == 'unknown'
+
+
+class FundingDB:
+    def __init__(self):
+        self.transitions = []
+
+    def transition_iyafix_plan(self, plan_id, from_status, data):
+        self.transitions.append((plan_id, from_status, data))
+        return [data]
+
+
+class FundingAPI:
+    def __init__(self, result):
+        self.result = result
+
+    def get_virtual_account_transaction(self, virtual_account_id):
+        return self.result
+
+
+def test_plan_is_activated_only_when_paid_in_full():
+    plan = dict(PLAN, virtual_account_id='va1', created_at='2026-10-01T00:00:00+00:00',
+                maturity_at='2026-10-31T00:00:00+00:00')
+    underpaid = FundingAPI({'status': 'success', 'data': {'data': {'status': 'Completed', 'amount': 100}}})
+    paid = FundingAPI({'status': 'success', 'data': {'data': {'status': 'Completed', 'amount': 5000}}})
+
+    db = FundingDB()
+    assert iyafix_scheduler.check_funding(db, underpaid, dict(plan, created_at='2999-01-01T00:00:00+00:00',
+                                                              maturity_at='2999-01-31T00:00:00+00:00')) == 'unfunded'
+    assert 'status' not in db.transitions[-1][2]
+
+    assert iyafix_scheduler.check_funding(db, paid, plan) == 'funded'
+    plan_id, from_status, data = db.transitions[-1]
+    assert (from_status, data['status']) == ('pending_funding', 'active')
+    funded_at = iyafix_scheduler.parse_timestamp(data['funded_at'])
+    assert (iyafix_scheduler.parse_timestamp(data['maturity_at']) - funded_at).days == 30
+
+
+def test_unpaid_plan_expires_after_funding_window():
+    db = FundingDB()
+    plan = dict(PLAN, virtual_account_id='va1', created_at='2026-01-01T00:00:00+00:00',
+                maturity_at='2026-01-31T00:00:00+00:00')
+
+    assert iyafix_scheduler.check_funding(db, FundingAPI({'status': 'error'}), plan) == 'expired'
+    assert db.transitions[-1][2] == {'status': 'expired'}
+
+
+def test_unfunded_plan_is_checked_again_after_a_growing_backoff():
+    db = FundingDB()
+    unpaid = FundingAPI({'status': 'success', 'data': {'data': {'status': 'Pending', 'amount': 0}}})
+    plan = dict(PLAN, virtual_account_id='va1', created_at='2999-01-01T00:00:00+00:00',
+                maturity_at='2999-01-31T00:00:00+00:00')
+
+    started = datetime.now(timezone.utc)
+    waits = []
+    for checks in (0, 1, 10):
+        assert iyafix_scheduler.check_funding(db, unpaid, dict(plan, funding_checks=checks)) == 'unfunded'
+        data = db.transitions[-1][2]
+        assert data['funding_checks'] == checks + 1
+        waits.append(iyafix_scheduler.parse_timestamp(data['next_funding_check_at']))
+
+    assert waits[0] < waits[1] < waits[2]
+    assert (waits[2] - started).total_seconds() <= iyafix_scheduler.MAX_FUNDING_CHECK_INTERVAL + 5
@@ -0,0 +1,93 @@
+"""
+Exercises the load_user_and_transition migration against a real Postgres.
+
+PostgREST's POST /rpc/load_user_and_transition is a plain call of the SQL function,
+so a scratch Postgres is enough of a stand-in. Point TEST_DATABASE_URL at a
+throwaway database (e.g. the one from `supabase start`, or a local docker postgres)
+with psycopg2 installed; every test runs inside a transaction that is rolled back.
+"""
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+MIGRATION = Path(__file__).resolve().parent.parent / "supabase" / "migrations" / "20261019000000_load_user_and_transition.sql"
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+
+@pytest.fixture
+def cursor():
+    conn = psycopg2.connect(DATABASE_URL)
+    cur = conn.cursor()
+    cur.execute("""
+        create table public.userdetails (
+            client text primary key,
+            "accountNumber" text,
+            transfer_flow_state text,
+            health_form_state text,
+            health_form_page integer
+        )
+    """)
+    cur.execute(MIGRATION.read_text())
+    cur.execute("""
+        insert into public.userdetails (client, "accountNumber", transfer_flow_state)
+        values ('+2348000000001', '0000000001', null),
+               ('+2348000000002', null, null)
+    """)
+    try:
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def call(cur, phone, flow_column=None, expected=None, new=None, data=None, require_column=None):
+    cur.execute(
+        "select public.load_user_and_transition(%s, %s, %s, %s, %s::jsonb, %s)",
+        (phone, flow_column, expected, new, json.dumps(data or {}), require_column)
+    )
+    return cur.fetchone()[0]
+
+
+def test_transition_applies_when_state_matches(cursor):
+    result = call(cursor, '+2348000000001', 'health_form_state', None, 'AWAITING_STATE_SELECTION',
+                  {'health_form_page': 1}, 'accountNumber')
+
+    assert result['transitioned'] is True
+    assert result['user']['health_form_state'] == 'AWAITING_STATE_SELECTION'
+    assert result['user']['health_form_page'] == 1
+    cursor.execute("select health_form_state, health_form_page from public.userdetails where client = '+2348000000001'")
+    assert cursor.fetchone() == ('AWAITING_STATE_SELECTION', 1)
+
+
+def test_transition_skipped_when_state_differs(cursor):
+    call(cursor, '+2348000000001', 'transfer_flow_state', None, 'AWAITING_RECIPIENT_ACCOUNT')
+    result = call(cursor, '+2348000000001', 'transfer_flow_state', None, 'AWAITING_AMOUNT')
+
+    assert result['transitioned'] is False
+    assert result['user']['transfer_flow_state'] == 'AWAITING_RECIPIENT_ACCOUNT'
+
+
+def test_transition_skipped_when_required_column_is_null(cursor):
+    result = call(cursor, '+2348000000002', 'transfer_flow_state', None, 'AWAITING_RECIPIENT_ACCOUNT',
+                  require_column='accountNumber')
+
+    assert result['transitioned'] is False
+    assert result['user']['transfer_flow_state'] is None
+
+
+def test_missing_user_returns_null(cursor):
+    assert call(cursor, '+2340000000000', 'transfer_flow_state', None, 'AWAITING_RECIPIENT_ACCOUNT') is None
+
+
+def test_null_flow_column_only_loads(cursor):
+    result = call(cursor, '+2348000000001')
+
+    assert result['transitioned'] is False
+    assert result['user']['client'] == '+2348000000001'
+    assert result['user']['transfer_flow_state'] is None
@@ -0,0 +1,126 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from record_spool import RecordSpool
+
+
+class StubHandler:
+    """Rejects any batch containing a record marked bad, like a constraint error would."""
+
+    def __init__(self):
+        self.inserted = []
+        self.available = True
+
+    def create_records(self, table_name, records, on_conflict=None):
+        if not self.available:
+            return {'status': 'error', 'error_type': 'transient', 'message': 'connection refused'}
+        if any(record.get('bad') for record in records):
+            return {'status': 'error', 'error_type': 'rejected', 'message': 'violates check constraint'}
+        if on_conflict:
+            # Skip records whose key already exists, like ON CONFLICT DO NOTHING
+            existing = {record[on_conflict] for record in self.inserted}
+            records = [record for record in records if record[on_conflict] not in existing]
+        self.inserted.extend(records)
+        return {'status': 'success', 'data': records}
+
+
+def make_spool(tmp_path, **kwargs):
+    return RecordSpool(StubHandler(), path=str(tmp_path / "spool.db"), batch_size=3, autostart=False, **kwargs)
+
+
+def make_due(spool):
+    spool._connect().execute("UPDATE spooled_records SET next_attempt_at = 0")
+
+
+def test_bad_record_does_not_block_its_batch(tmp_path):
+    spool = make_spool(tmp_path)
+    for record in ({'n': 1}, {'n': 2, 'bad': True}, {'n': 3}, {'n': 4}):
+        spool.enqueue('plaschema', record)
+
+    assert spool.flush() == 3
+    assert [record['n'] for record in spool.db.inserted] == [1, 3, 4]
+    assert spool.pending_count('plaschema') == 1
+
+
+def test_record_is_dead_lettered_after_max_attempts(tmp_path):
+    spool = make_spool(tmp_path, max_attempts=2)
+    spool.enqueue('plaschema', {'n': 1, 'bad': True})
+
+    for _ in range(2):
+        make_due(spool)
+        spool.flush()
+
+    assert spool.pending_count() == 0
+    dead = spool.dead_letters('plaschema')
+    assert len(dead) == 1
+    assert dead[0]['record'] == {'n': 1, 'bad': True}
+    assert dead[0]['attempts'] == 2
+
+
+def test_flush_drains_other_tables_after_a_failure(tmp_path):
+    spool = make_spool(tmp_path)
+    spool.enqueue('plaschema', {'n': 1, 'bad': True})
+    spool.enqueue('other', {'n': 2})
+
+    assert spool.flush() == 1
+    assert spool.db.inserted == [{'n': 2}]
+
+
+def test_outage_never_dead_letters(tmp_path):
+    spool = make_spool(tmp_path, max_attempts=2)
+    spool.db.available = False
+    for n in range(4):
+        spool.enqueue('plaschema', {'n': n})
+
+    for _ in range(5):
+        make_due(spool)
+        assert spool.flush() == 0
+
+    assert spool.dead_letters() == []
+    assert spool._connect().execute("SELECT MAX(attempts) FROM spooled_records").fetchone()[0] == 0
+
+    spool.db.available = True
+    make_due(spool)
+    assert spool.flush() == 4
+    assert spool.pending_count() == 0
+
+
+def test_replayed_dead_letter_is_delivered(tmp_path):
+    spool = make_spool(tmp_path, max_attempts=1)
+    spool.enqueue('plaschema', {'n': 1, 'bad': True})
+    spool.flush()
+    dead = spool.dead_letters()
+    assert len(dead) == 1
+
+    # The record was fixed upstream (e.g. a missing column was added)
+    spool.db.create_records = lambda table_name, records, on_conflict=None: {'status': 'success', 'data': records}
+    assert spool.replay_dead_letters(ids=[dead[0]['id']]) == 1
+    assert spool.flush() == 1
+    assert spool.dead_letters() == [] and spool.pending_count() == 0
+
+
+def test_handler_is_built_lazily(tmp_path):
+    built = []
+
+    def factory():
+        built.append(True)
+        return StubHandler()
+
+    spool = RecordSpool(factory, path=str(tmp_path / "spool.db"), autostart=False)
+    spool.enqueue('plaschema', {'n': 1})
+    assert built == []
+    assert spool.flush() == 1
+    assert built == [True]
+
+
+def test_upsert_key_treats_an_existing_record_as_delivered(tmp_path):
+    spool = make_spool(tmp_path, upsert_keys={'iyafix_plans': 'key'})
+    spool.db.inserted.append({'key': 'va1', 'n': 1})  # the direct insert landed after all
+    spool.enqueue('iyafix_plans', {'key': 'va1', 'n': 1})
+    spool.enqueue('iyafix_plans', {'key': 'va2', 'n': 2})
+
+    assert spool.flush() == 2
+    assert spool.db.inserted == [{'key': 'va1', 'n': 1}, {'key': 'va2', 'n': 2}]
+    assert spool.pending_count() == 0 and spool.dead_letters() == []
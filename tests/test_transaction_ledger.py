@@ -0,0 +1,52 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from transaction_ledger import TransactionLedger
+
+
+def test_pending_row_is_resolved_by_its_result(tmp_path):
+    ledger = TransactionLedger(str(tmp_path / "ledger.db"))
+    ledger.record('transfer', {'amount': 5}, None, 0, reference='ABCD', request_id='r1', started_at=0)
+    ledger.record('transfer', {'amount': 5}, {'status': 'success'}, 12, reference='ABCD', request_id='r1', started_at=0)
+    ledger.record('transfer', {'amount': 7}, None, 0, reference='EFGH', request_id='r2', started_at=0)
+
+    entries = ledger.resolve(ledger.entries_for_day('1970-01-01'))
+
+    assert [(entry['reference'], entry['status']) for entry in entries] == [('ABCD', 'success'), ('EFGH', 'pending')]
+
+
+def test_entries_cannot_be_changed(tmp_path):
+    ledger = TransactionLedger(str(tmp_path / "ledger.db"))
+    ledger.record('transfer', {}, {'status': 'error'}, 1, reference='ABCD')
+
+    with pytest.raises(sqlite3.IntegrityError):
+        ledger._connect().execute("UPDATE ledger_entries SET status = 'success'")
+    with pytest.raises(sqlite3.IntegrityError):
+        ledger._connect().execute("DELETE FROM ledger_entries")
+
+
+def test_each_call_gets_a_unique_reference_tied_to_its_ledger_rows(tmp_path):
+    pytest.importorskip("supabase")
+    pytest.importorskip("requests")
+    from api_handler import SafeHavenAPI
+
+    api = SafeHavenAPI.__new__(SafeHavenAPI)  # skip the access-token lookup
+    api.ledger = TransactionLedger(str(tmp_path / "ledger.db"))
+    sent = []
+    api._make_request = lambda method, endpoint, payload=None: sent.append(payload) or {'status': 'success', 'data': {}}
+
+    for _ in range(2):
+        api.initiate_transfer('NE1', '0100000001', '090286', '0100000002', 500)
+    api.create_virtual_account('0100000001', 500)
+
+    references = [sent[0]['paymentReference'], sent[1]['paymentReference'], sent[2]['externalReference']]
+    assert len(set(references)) == 3
+    for reference in references:
+        entries = api.ledger.entries_for_reference(reference)
+        assert [entry['status'] for entry in entries] == ['pending', 'success']
+        assert reference == SafeHavenAPI.unique_reference(entries[0]['request_id'])
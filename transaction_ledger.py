@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class TransactionLedger:
+    """
+    Local append-only ledger of every money-moving SafeHaven request and its response.
+
+    Backed by SQLite in WAL mode with synchronous=NORMAL, so a write on the USSD hot
+    path is a single small append. UPDATE and DELETE are rejected by triggers, so each
+    call is logged twice: a 'pending' row before the request is sent and a result row
+    afterwards, linked by request_id. A request whose worker died mid-call is left with
+    only its pending row. resolve() collapses the pair to the latest row.
+    Entries are indexed by phone number, account, reference and day for range queries
+    and for the batch reconciliation job (see reconcile_ledger.py).
+    """
+
+    COLUMNS = (
+        'id', 'created_at', 'day', 'operation', 'phone_number', 'account_number',
+        'beneficiary_account', 'reference', 'amount', 'status', 'duration_ms',
+        'request', 'response', 'request_id'
+    )
+
+    def __init__(self, path: str = None):
+        self.path = path or os.environ.get("LEDGER_PATH", "ledger.db")
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        # A connection inherited across fork (gunicorn --preload) must not be reused
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ledger_entries'").fetchone():
+            self._init_schema_upgrades(conn)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS ledger_entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                day TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                phone_number TEXT,
+                account_number TEXT,
+                beneficiary_account TEXT,
+                reference TEXT,
+                amount INTEGER,
+                status TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                request TEXT,
+                response TEXT,
+                request_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_ledger_request_id ON ledger_entries (request_id);
+            CREATE INDEX IF NOT EXISTS idx_ledger_phone ON ledger_entries (phone_number, created_at);
+            CREATE INDEX IF NOT EXISTS idx_ledger_account ON ledger_entries (account_number, created_at);
+            CREATE INDEX IF NOT EXISTS idx_ledger_beneficiary ON ledger_entries (beneficiary_account, created_at);
+            CREATE INDEX IF NOT EXISTS idx_ledger_reference ON ledger_entries (reference);
+            CREATE INDEX IF NOT EXISTS idx_ledger_day ON ledger_entries (day, operation);
+            CREATE TRIGGER IF NOT EXISTS ledger_entries_no_update BEFORE UPDATE ON ledger_entries
+            BEGIN SELECT RAISE(ABORT, 'ledger_entries is append-only'); END;
+            CREATE TRIGGER IF NOT EXISTS ledger_entries_no_delete BEFORE DELETE ON ledger_entries
+            BEGIN SELECT RAISE(ABORT, 'ledger_entries is append-only'); END;
+        """)
+
+    def _init_schema_upgrades(self, conn):
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(ledger_entries)")]
+        if 'request_id' not in columns:
+            conn.execute("ALTER TABLE ledger_entries ADD COLUMN request_id TEXT")
+
+    def record(self, operation: str, request: dict, response: dict, duration_ms: int,
+               phone_number: str = None, account_number: str = None, beneficiary_account: str = None,
+               reference: str = None, amount: int = None, request_id: str = None, started_at: float = None):
+        """
+        Appends one ledger row. Pass response=None for the 'pending' row written before
+        the request is sent. `started_at` fixes the day both rows of a call are filed under.
+        Never raises: the hop must not fail on a ledger error.
+        """
+        now = time.time()
+        day = datetime.fromtimestamp(now if started_at is None else started_at, timezone.utc).strftime('%Y-%m-%d')
+        status = 'pending' if response is None else response.get('status', 'error')
+        try:
+            self._connect().execute("""
+                INSERT INTO ledger_entries (
+                    created_at, day, operation, phone_number, account_number, beneficiary_account,
+                    reference, amount, status, duration_ms, request, response, request_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                now, day, operation, phone_number, account_number, beneficiary_account,
+                reference, amount, status, int(duration_ms), json.dumps(request),
+                json.dumps(response) if response is not None else None, request_id
+            ))
+        except sqlite3.Error as e:
+            print(f"Error writing ledger entry for {operation}: {e}")
+
+    def _select(self, where: str, params: tuple, start: float = None, end: float = None):
+        clauses = [where]
+        args = list(params)
+        if start is not None:
+            clauses.append("created_at >= ?")
+            args.append(start)
+        if end is not None:
+            clauses.append("created_at < ?")
+            args.append(end)
+        rows = self._connect().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM ledger_entries WHERE {' AND '.join(clauses)} ORDER BY created_at",
+            args
+        ).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(self.COLUMNS, row))
+            entry['request'] = json.loads(entry['request']) if entry['request'] else None
+            entry['response'] = json.loads(entry['response']) if entry['response'] else None
+            entries.append(entry)
+        return entries
+
+    def entries_for_phone(self, phone_number: str, start: float = None, end: float = None):
+        return self._select("phone_number = ?", (phone_number,), start, end)
+
+    def entries_for_account(self, account_number: str, start: float = None, end: float = None):
+        """Entries where the account was either debited or the beneficiary."""
+        debits = self._select("account_number = ?", (account_number,), start, end)
+        credits = self._select("beneficiary_account = ? AND account_number IS NOT ?",
+                               (account_number, account_number), start, end)
+        return sorted(debits + credits, key=lambda entry: entry['created_at'])
+
+    def entries_for_reference(self, reference: str):
+        return self._select("reference = ?", (reference,))
+
+    def entries_for_day(self, day: str, operation: str = None):
+        """All entries for a UTC day ('YYYY-MM-DD'), optionally for one operation."""
+        if operation:
+            return self._select("day = ? AND operation = ?", (day, operation))
+        return self._select("day = ?", (day,))
+
+    @staticmethod
+    def resolve(entries):
+        """Collapses the pending/result rows of each call to its latest row, keeping order."""
+        latest = {}
+        for entry in entries:
+            latest[entry['request_id'] or f"row-{entry['id']}"] = entry
+        return sorted(latest.values(), key=lambda entry: entry['created_at'])